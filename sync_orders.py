@@ -4,18 +4,24 @@ Script to sync order totals from two PostgreSQL databases to Google Sheets.
 """
 
 import argparse
+import hashlib
+import json
 import os
 import sys
-from datetime import datetime, timedelta
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 from typing import List, Optional, Tuple, Dict
 
-import psycopg
-from dotenv import load_dotenv
-import gspread
-from google.oauth2.service_account import Credentials
+# psycopg, gspread, google-auth and python-dotenv are imported where they are
+# used, so --help and argument errors don't pay for loading them.
 
+# Rows per Sheets write request, and attempts per request when throttled
+SHEETS_BATCH_SIZE = 500
+SHEETS_MAX_ATTEMPTS = 6
 
-def parse_arguments() -> Tuple[str, str, bool]:
+
+def parse_arguments() -> Tuple[date, date, bool, bool]:
     """Parse command line arguments."""
     parser = argparse.ArgumentParser(
         description='Sync order totals from PostgreSQL databases to Google Sheets'
@@ -49,59 +55,59 @@ def parse_arguments() -> Tuple[str, str, bool]:
         action='store_true',
         help='Overwrite existing rows with matching dates instead of skipping them'
     )
+    parser.add_argument(
+        '--assume-new',
+        action='store_true',
+        help='Skip reading existing dates from the sheet and append every date '
+             '(only use when the dates are known not to exist yet)'
+    )
 
     args = parser.parse_args()
 
     # Calculate dates based on offsets or use provided dates
-    today = datetime.now()
+    today = date.today()
 
-    if args.from_date_offset is not None:
-        from_date = (today + timedelta(days=args.from_date_offset)).strftime('%Y-%m-%d')
-    elif args.from_date:
-        from_date = args.from_date
-    else:
-        from_date = today.strftime('%Y-%m-%d')
-
-    if args.to_date_offset is not None:
-        to_date = (today + timedelta(days=args.to_date_offset)).strftime('%Y-%m-%d')
-    elif args.to_date:
-        to_date = args.to_date
-    else:
-        to_date = today.strftime('%Y-%m-%d')
-
-    # Validate date format
     try:
-        datetime.strptime(from_date, '%Y-%m-%d')
-        datetime.strptime(to_date, '%Y-%m-%d')
+        if args.from_date_offset is not None:
+            from_date = today + timedelta(days=args.from_date_offset)
+        elif args.from_date:
+            from_date = datetime.strptime(args.from_date, '%Y-%m-%d').date()
+        else:
+            from_date = today
+
+        if args.to_date_offset is not None:
+            to_date = today + timedelta(days=args.to_date_offset)
+        elif args.to_date:
+            to_date = datetime.strptime(args.to_date, '%Y-%m-%d').date()
+        else:
+            to_date = today
     except ValueError as e:
         print(f"Error: Invalid date format. Use YYYY-MM-DD. {e}")
         sys.exit(1)
 
-    return from_date, to_date, args.overwrite
-
+    if args.assume_new and args.overwrite:
+        print("Error: --assume-new and --overwrite cannot be used together")
+        sys.exit(1)
 
-def generate_date_range(from_date: str, to_date: str) -> List[str]:
-    """Generate a list of dates between from_date and to_date (inclusive)."""
-    start = datetime.strptime(from_date, '%Y-%m-%d')
-    end = datetime.strptime(to_date, '%Y-%m-%d')
+    return from_date, to_date, args.overwrite, args.assume_new
 
-    dates = []
-    current = start
-    while current <= end:
-        dates.append(current.strftime('%Y-%m-%d'))
-        current += timedelta(days=1)
 
-    return dates
+def generate_date_range(from_date: date, to_date: date) -> List[date]:
+    """Generate a list of dates between from_date and to_date (inclusive)."""
+    return [from_date + timedelta(days=i) for i in range((to_date - from_date).days + 1)]
 
 
 def get_db_connection(host: str, database: str, user: str, password: str):
     """Create a PostgreSQL database connection."""
+    import psycopg
+
     try:
         conn = psycopg.connect(
             host=host,
             dbname=database,
             user=user,
-            password=password
+            password=password,
+            application_name='gdfoods-sync-orders'
         )
         return conn
     except psycopg.Error as e:
@@ -109,23 +115,53 @@ def get_db_connection(host: str, database: str, user: str, password: str):
         sys.exit(1)
 
 
-def fetch_order_total(conn, date: str) -> float:
-    """Fetch order total from database for a specific date."""
+def fetch_order_totals(
+    conn,
+    from_date: date,
+    to_date: date,
+    daily_totals_view: Optional[str] = None
+) -> Dict[date, float]:
+    """Fetch daily order totals from database for a date range (inclusive)."""
+    import psycopg
+    from psycopg import sql
+
     query = """
-        SELECT SUM(order_total)
+        SELECT fo_day, COALESCE(SUM(order_total), 0)::float8
         FROM orders_hist
         WHERE (sp_id=2 OR sp_id=3)
         AND payment_id=1
         AND order_total IS NOT NULL
         AND order_status_id <> 6
-        AND fo_day = %s
+        AND fo_day BETWEEN %s AND %s
+        GROUP BY fo_day
     """
+    params = (from_date, to_date)
+
+    if daily_totals_view:
+        # Closed days come from the pre-aggregated view. The view is only
+        # refreshed nightly, so yesterday and today are still summed live.
+        query = sql.SQL("""
+            SELECT fo_day, total::float8
+            FROM {view}
+            WHERE fo_day BETWEEN %s AND %s
+            AND fo_day < CURRENT_DATE - 1
+            UNION ALL
+            SELECT fo_day, COALESCE(SUM(order_total), 0)::float8
+            FROM orders_hist
+            WHERE (sp_id=2 OR sp_id=3)
+            AND payment_id=1
+            AND order_total IS NOT NULL
+            AND order_status_id <> 6
+            AND fo_day BETWEEN %s AND %s
+            AND fo_day >= CURRENT_DATE - 1
+            GROUP BY fo_day
+        """).format(view=sql.Identifier(*daily_totals_view.split('.')))
+        params = params * 2
 
     try:
-        with conn.cursor() as cursor:
-            cursor.execute(query, (date,))
-            result = cursor.fetchone()[0]
-            return float(result) if result is not None else 0.0
+        with conn.cursor(binary=True) as cursor:
+            cursor.execute(query, params)
+            return dict(cursor.fetchall())
     except psycopg.Error as e:
         print(f"Error executing query: {e}")
         sys.exit(1)
@@ -133,6 +169,11 @@ def fetch_order_total(conn, date: str) -> float:
 
 def get_google_sheet(spreadsheet_id: str, credentials_file: str):
     """Get Google Sheets client and sheet object."""
+    import gspread
+    from google.oauth2.service_account import Credentials
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
     try:
         scopes = [
             'https://www.googleapis.com/auth/spreadsheets',
@@ -140,6 +181,16 @@ def get_google_sheet(spreadsheet_id: str, credentials_file: str):
         ]
         creds = Credentials.from_service_account_file(credentials_file, scopes=scopes)
         client = gspread.authorize(creds)
+
+        # All Sheets calls share one keep-alive session; retry throttled or
+        # failed requests. Retry's default allowed_methods excludes POST, so
+        # appends are never replayed here.
+        retry = Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
+        client.http_client.session.mount(
+            'https://',
+            HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry)
+        )
+
         sheet = client.open_by_key(spreadsheet_id).sheet1
         return sheet
     except Exception as e:
@@ -147,82 +198,205 @@ def get_google_sheet(spreadsheet_id: str, credentials_file: str):
         sys.exit(1)
 
 
-def get_existing_dates(sheet) -> Dict[str, int]:
-    """Get a dictionary mapping dates to their row numbers in the sheet."""
+def load_cached_dates(cache_file: str, spreadsheet_id: str) -> Dict[str, int]:
+    """Load cached date-to-row mapping for a spreadsheet, or an empty dict."""
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    # Anything malformed is treated as no cache, forcing a full read
+    if not isinstance(cache, dict) or cache.get('spreadsheet_id') != spreadsheet_id:
+        return {}
+    dates = cache.get('dates')
+    if not isinstance(dates, dict) or not all(
+        isinstance(date, str) and type(row_num) is int and row_num > 0
+        for date, row_num in dates.items()
+    ):
+        return {}
+    return dates
+
+
+def save_cached_dates(cache_file: str, spreadsheet_id: str, date_to_row: Dict[str, int]):
+    """Persist date-to-row mapping so the next run only reads new rows."""
     try:
-        all_values = sheet.get_all_values()
-        date_to_row = {}
+        with open(cache_file, 'w') as f:
+            json.dump({'spreadsheet_id': spreadsheet_id, 'dates': date_to_row}, f)
+    except OSError as e:
+        print(f"Warning: could not write existing dates cache {cache_file}: {e}")
+
+
+def read_new_dates(sheet, cached: Dict[str, int]) -> Optional[Dict[str, int]]:
+    """Extend cached dates with rows added since, or None if the cache is stale."""
+    last_row = max(cached.values(), default=0)
+    if not last_row or sheet.row_count < last_row:
+        return None
+
+    # Read from the last cached row on; it must still hold the cached date
+    last_date = next(date for date, row_num in cached.items() if row_num == last_row)
+    # Column-major read returns a flat list of cells instead of one list per row
+    values = sheet.get(f'A{last_row}:A', major_dimension='COLUMNS')
+    column = values[0] if values else []
+    if not column or column[0] != last_date:
+        return None
+
+    date_to_row = dict(cached)
+    date_to_row.update(
+        (date, row_num) for row_num, date in enumerate(column[1:], start=last_row + 1) if date
+    )
+    return date_to_row
 
-        # Start from row 1 (index 0) - assuming no header row
-        # If there's a header, change range(len(all_values)) to range(1, len(all_values))
-        for idx, row in enumerate(all_values):
-            if row and len(row) > 0:
-                date = row[0]
-                # Row number in Google Sheets (1-indexed)
-                date_to_row[date] = idx + 1
 
+def get_existing_dates(sheet, cache_file: Optional[str] = None) -> Dict[str, int]:
+    """Get a dictionary mapping dates to their row numbers in the sheet."""
+    try:
+        spreadsheet_id = sheet.spreadsheet_id
+        date_to_row = None
+        if cache_file:
+            date_to_row = read_new_dates(sheet, load_cached_dates(cache_file, spreadsheet_id))
+
+        if date_to_row is None:
+            # Only column A (dates) is needed, so avoid downloading the whole sheet.
+            # Row numbers are 1-indexed and assume no header row.
+            dates = sheet.col_values(1)
+            date_to_row = {date: idx + 1 for idx, date in enumerate(dates) if date}
+
+        if cache_file:
+            save_cached_dates(cache_file, spreadsheet_id, date_to_row)
         return date_to_row
     except Exception as e:
         print(f"Error reading existing data from Google Sheets: {e}")
         sys.exit(1)
 
 
-def update_or_append_row(
+def build_row(date_str: str, juan_total: float, texans_total: float, row_num: int) -> List:
+    """Build the full sheet row (values and formulas) for a given row number."""
+    sum_formula = f'=SUM(B{row_num}:C{row_num})'
+    sumifs_formula = f'=SUMIFS(\'Απαντήσεις φόρμας\'!C:C; \'Απαντήσεις φόρμας\'!A:A; ">="&DATEVALUE($A{row_num}); \'Απαντήσεις φόρμας\'!A:A; "<"&(DATEVALUE($A{row_num})+1))'
+
+    # For the cumulative formula, reference the previous row
+    prev_row = row_num - 1
+    cumulative_formula = f'=F{prev_row}+D{row_num}-E{row_num}' if prev_row > 0 else f'=D{row_num}-E{row_num}'
+
+    return [date_str, juan_total, texans_total, sum_formula, sumifs_formula, cumulative_formula]
+
+
+def call_with_backoff(func, *args, retry_statuses=(429, 500, 502, 503, 504), **kwargs):
+    """Call a Sheets API method, retrying with exponential backoff on retryable errors."""
+    from gspread.exceptions import APIError
+
+    for attempt in range(SHEETS_MAX_ATTEMPTS):
+        try:
+            return func(*args, **kwargs)
+        except APIError as e:
+            status = e.response.status_code
+            if status not in retry_statuses or attempt == SHEETS_MAX_ATTEMPTS - 1:
+                raise
+            delay = min(2 ** attempt, 30)
+            print(f"Google Sheets returned {status}, retrying in {delay}s...")
+            time.sleep(delay)
+
+
+def append_rows(sheet, new_rows: List[Tuple[str, float, float]], next_row: Optional[int]) -> int:
+    """Append new rows, making sure the formulas match the rows they land on.
+
+    The Sheets API appends after the last non-empty row of the table, which
+    may differ from next_row (e.g. trailing rows with a blank date column).
+    The landing row is therefore always taken from the append response, and
+    the formulas rewritten if it differs. When next_row is unknown (existing
+    dates were not read), only the values are appended at first.
+    Returns the row number following the appended rows.
+    """
+    from gspread.utils import a1_to_rowcol
+
+    if next_row is not None:
+        payload = [build_row(*values, row_num) for row_num, values in enumerate(new_rows, start=next_row)]
+    else:
+        payload = [list(values) for values in new_rows]
+
+    # An append that failed with a 5xx may still have been applied, so only
+    # retry appends that were rejected outright for exceeding the quota
+    response = call_with_backoff(
+        sheet.append_rows,
+        payload,
+        value_input_option='USER_ENTERED',
+        retry_statuses=(429,)
+    )
+    updated_range = response['updates']['updatedRange']
+    landed_row, _ = a1_to_rowcol(updated_range.split('!')[-1].split(':')[0])
+
+    rows = [build_row(*values, row_num) for row_num, values in enumerate(new_rows, start=landed_row)]
+    if landed_row != next_row:
+        formulas = [
+            {'range': f'D{row_num}:F{row_num}', 'values': [row[3:]]}
+            for row_num, row in enumerate(rows, start=landed_row)
+        ]
+        call_with_backoff(sheet.batch_update, formulas, value_input_option='USER_ENTERED')
+
+    for row_num, row in enumerate(rows, start=landed_row):
+        print(f"Added row {row_num}: {row}")
+    return landed_row + len(rows)
+
+
+def write_rows(
     sheet,
-    date_str: str,
-    juan_total: float,
-    texans_total: float,
-    existing_dates: Dict[str, int],
-    overwrite: bool
+    new_rows: List[Tuple[str, float, float]],
+    to_update: List[Dict],
+    next_row: Optional[int]
 ):
-    """Update an existing row or append a new one based on overwrite flag."""
+    """Write all pending rows to the sheet in batches of SHEETS_BATCH_SIZE rows."""
     try:
-        if date_str in existing_dates:
-            row_num = existing_dates[date_str]
-            if overwrite:
-                # Create formulas for existing row
-                sum_formula = f'=SUM(B{row_num}:C{row_num})'
-                sumifs_formula = f'=SUMIFS(\'Απαντήσεις φόρμας\'!C:C; \'Απαντήσεις φόρμας\'!A:A; ">="&DATEVALUE($A{row_num}); \'Απαντήσεις φόρμας\'!A:A; "<"&(DATEVALUE($A{row_num})+1))'
-
-                # For the cumulative formula, reference the previous row
-                prev_row = row_num - 1
-                cumulative_formula = f'=F{prev_row}+D{row_num}-E{row_num}' if prev_row > 0 else f'=D{row_num}-E{row_num}'
-
-                row = [date_str, juan_total, texans_total, sum_formula, sumifs_formula, cumulative_formula]
-                sheet.update(values=[row], range_name=f'A{row_num}:F{row_num}', value_input_option='USER_ENTERED')
-                print(f"Updated row {row_num}: {row}")
-            else:
-                print(f"Skipping {date_str} (already exists)")
-        else:
-            # For new rows, determine the next row number
-            # Get current row count to determine the row number
-            all_values = sheet.get_all_values()
-            row_num = len(all_values) + 1
-
-            # Create formulas for new row
-            sum_formula = f'=SUM(B{row_num}:C{row_num})'
-            sumifs_formula = f'=SUMIFS(\'Απαντήσεις φόρμας\'!C:C; \'Απαντήσεις φόρμας\'!A:A; ">="&DATEVALUE($A{row_num}); \'Απαντήσεις φόρμας\'!A:A; "<"&(DATEVALUE($A{row_num})+1))'
-
-            # For the cumulative formula, reference the previous row
-            prev_row = row_num - 1
-            cumulative_formula = f'=F{prev_row}+D{row_num}-E{row_num}' if prev_row > 0 else f'=D{row_num}-E{row_num}'
-
-            row = [date_str, juan_total, texans_total, sum_formula, sumifs_formula, cumulative_formula]
-            sheet.append_row(row, value_input_option='USER_ENTERED')
-            print(f"Added new row: {row}")
+        for start in range(0, len(to_update), SHEETS_BATCH_SIZE):
+            batch = to_update[start:start + SHEETS_BATCH_SIZE]
+            call_with_backoff(sheet.batch_update, batch, value_input_option='USER_ENTERED')
+            print(f"Updated {len(batch)} existing rows")
+        for start in range(0, len(new_rows), SHEETS_BATCH_SIZE):
+            next_row = append_rows(sheet, new_rows[start:start + SHEETS_BATCH_SIZE], next_row)
     except Exception as e:
         print(f"Error writing to Google Sheets: {e}")
         sys.exit(1)
 
 
+def run_cache_key(*parts) -> str:
+    """Hash the parameters that identify a sync run."""
+    return hashlib.sha256(json.dumps([str(part) for part in parts]).encode()).hexdigest()
+
+
+def is_recent_run(cache_file: str, key: str, ttl_seconds: int) -> bool:
+    """Check whether the same sync run last succeeded within ttl_seconds."""
+    try:
+        with open(cache_file) as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return False
+
+    if not isinstance(cache, dict) or not isinstance(cache.get('ts'), (int, float)):
+        return False
+    return cache.get('key') == key and time.time() - cache['ts'] < ttl_seconds
+
+
+def record_run(cache_file: str, key: str):
+    """Remember a successful sync run so repeats within the TTL are skipped."""
+    try:
+        cache_dir = os.path.dirname(cache_file)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        with open(cache_file, 'w') as f:
+            json.dump({'key': key, 'ts': time.time()}, f)
+    except OSError as e:
+        print(f"Warning: could not write sync cache {cache_file}: {e}")
+
+
 def main():
     """Main execution function."""
+    # Parse command line arguments
+    from_date, to_date, overwrite, assume_new = parse_arguments()
+
     # Load environment variables
+    from dotenv import load_dotenv
     load_dotenv()
 
-    # Parse command line arguments
-    from_date, to_date, overwrite = parse_arguments()
-
     print(f"Processing dates: {from_date} to {to_date}")
     print(f"Overwrite mode: {'enabled' if overwrite else 'disabled'}")
 
@@ -239,6 +413,9 @@ def main():
 
     google_sheet_id = os.getenv('GOOGLE_SHEET_ID')
     google_creds_file = os.getenv('GOOGLE_CREDENTIALS_FILE', 'credentials.json')
+    existing_dates_cache = os.getenv('EXISTING_DATES_CACHE_FILE')
+    daily_totals_view = os.getenv('DAILY_TOTALS_VIEW')
+    sync_cache_file = os.path.expanduser(os.getenv('SYNC_CACHE_FILE', '~/.cache/gdfoods/last.json'))
 
     # Validate required environment variables
     required_vars = [
@@ -258,54 +435,84 @@ def main():
         print(f"Error: Missing required environment variables: {', '.join(missing_vars)}")
         sys.exit(1)
 
+    try:
+        sync_cache_ttl = int(os.getenv('SYNC_CACHE_TTL_SECONDS', '0'))
+    except ValueError:
+        print("Error: SYNC_CACHE_TTL_SECONDS must be an integer number of seconds")
+        sys.exit(1)
+
+    # Skip the whole sync if the same run already succeeded within the TTL
+    run_key = run_cache_key(google_sheet_id, from_date, to_date, overwrite, assume_new)
+    if sync_cache_ttl > 0 and is_recent_run(sync_cache_file, run_key, sync_cache_ttl):
+        print(f"Same sync already ran within the last {sync_cache_ttl}s, nothing to do")
+        return
+
     # Generate list of dates to process
     dates_to_process = generate_date_range(from_date, to_date)
     print(f"Total dates to process: {len(dates_to_process)}")
 
-    # Connect to databases
-    print("Connecting to Juan's database...")
-    juan_conn = get_db_connection(juan_host, juan_db, juan_user, juan_pass)
-
-    print("Connecting to Texans database...")
-    texans_conn = get_db_connection(texans_host, texans_db, texans_user, texans_pass)
+    # Connect to both databases in parallel (each thread gets its own connection)
+    print("Connecting to Juan's and Texans databases...")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        juan_future = executor.submit(get_db_connection, juan_host, juan_db, juan_user, juan_pass)
+        texans_future = executor.submit(get_db_connection, texans_host, texans_db, texans_user, texans_pass)
+        juan_conn, texans_conn = juan_future.result(), texans_future.result()
 
     # Connect to Google Sheets and get existing data
     print("Connecting to Google Sheets...")
     sheet = get_google_sheet(google_sheet_id, google_creds_file)
-    existing_dates = get_existing_dates(sheet)
-    print(f"Found {len(existing_dates)} existing rows in spreadsheet")
-
-    # Process each date
+    if assume_new:
+        print("Assuming all dates are new, not reading existing rows")
+        existing_dates = {}
+        next_row = None
+    else:
+        existing_dates = get_existing_dates(sheet, existing_dates_cache)
+        print(f"Found {len(existing_dates)} existing rows in spreadsheet")
+        next_row = max(existing_dates.values(), default=0) + 1
+
+    # Fetch totals for the whole date range from both databases concurrently
+    print("Fetching Juan's and Texans totals...")
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        juan_future = executor.submit(fetch_order_totals, juan_conn, from_date, to_date, daily_totals_view)
+        texans_future = executor.submit(fetch_order_totals, texans_conn, from_date, to_date, daily_totals_view)
+        juan_totals, texans_totals = juan_future.result(), texans_future.result()
+
+    # Process each date, collecting the sheet writes so they go out in one batch
     print("\nProcessing dates:")
-    for date in dates_to_process:
-        print(f"\nDate: {date}")
+    new_rows = []
+    to_update = []
+    for day in dates_to_process:
+        date_str = day.strftime('%Y-%m-%d')
+        print(f"\nDate: {date_str}")
 
-        # Fetch totals from both databases
-        juan_total = fetch_order_total(juan_conn, date)
+        juan_total = juan_totals.get(day, 0.0)
         print(f"  Juan's total: {juan_total}")
 
-        texans_total = fetch_order_total(texans_conn, date)
+        texans_total = texans_totals.get(day, 0.0)
         print(f"  Texans total: {texans_total}")
 
-        # Update or append to Google Sheets
-        update_or_append_row(
-            sheet,
-            date,
-            juan_total,
-            texans_total,
-            existing_dates,
-            overwrite
-        )
+        if date_str not in existing_dates:
+            new_rows.append((date_str, juan_total, texans_total))
+            print("  Queued as new row")
+        elif overwrite:
+            row_num = existing_dates[date_str]
+            row = build_row(date_str, juan_total, texans_total, row_num)
+            to_update.append({'range': f'A{row_num}:F{row_num}', 'values': [row]})
+            print(f"  Queued update of row {row_num}: {row}")
+        else:
+            print(f"  Skipping {date_str} (already exists)")
 
-        # Update existing_dates dict if we added a new row
-        if date not in existing_dates:
-            # Approximate row number (actual row number will be at the end)
-            existing_dates[date] = len(existing_dates) + 1
+    # Write all changes to Google Sheets
+    print("\nWriting to Google Sheets...")
+    write_rows(sheet, new_rows, to_update, next_row)
 
     # Close database connections
     juan_conn.close()
     texans_conn.close()
 
+    if sync_cache_ttl > 0:
+        record_run(sync_cache_file, run_key)
+
     print("\nDone!")
 
 